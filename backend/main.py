@@ -1,24 +1,38 @@
 # backend/main.py
 from pathlib import Path
-from typing import Dict, Set, Tuple, Optional
+from typing import Dict, List, Set, Tuple, Optional, Union
+import asyncio
+import base64
 import logging
 import secrets
+import string
 import time
 import re
 import json
 import os
 import hmac
 import hashlib
-from collections import defaultdict
+import heapq
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from starlette.websockets import WebSocketState
+from starlette.datastructures import URL
 from pydantic import BaseModel
+from urllib.parse import urlsplit
 from uuid import uuid4
 
+# orjson (C) er vesentlig raskere enn stdlib json på små WS-rammer; stdlib som fallback
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Load .env tidlig (fra prosjektroten: ../.env relativt til denne fila)
 try:
@@ -36,36 +50,87 @@ log = logging.getLogger("server")
 # Paths / app
 BASE_DIR = Path(__file__).resolve().parent
 ROOT_DIR = BASE_DIR.parent
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Periodisk opprydding av IP-tabellene (se _rate_table_gc_loop) så lenge appen kjører
+    gc_task = asyncio.create_task(_rate_table_gc_loop())
+    try:
+        yield
+    finally:
+        gc_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CSPRNG-pool for nonces/tokens
+# secrets.token_urlsafe gjør én getrandom()-syscall pr. kall. Vi leser heller 64 KB
+# fra os.urandom om gangen og deler ut biter av bufferen (hver bit brukes kun én gang).
+RNG_POOL_BYTES = 65536
+
+class _RngPool:
+    __slots__ = ("buf", "pos", "lock")
+
+    def __init__(self):
+        self.buf = b""
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        # Kalles i barneprosess etter fork: aldri del ubrukte bytes med forelderen
+        self.buf = b""
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def take(self, n: int) -> bytes:
+        with self.lock:
+            if self.pos + n > len(self.buf):
+                self.buf = os.urandom(RNG_POOL_BYTES)
+                self.pos = 0
+            start = self.pos
+            self.pos = start + n
+            return self.buf[start:self.pos]
+
+_rng_pool = _RngPool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_rng_pool.reset)
+
+def _token_urlsafe(nbytes: int) -> str:
+    """Som secrets.token_urlsafe, men fra _rng_pool."""
+    return base64.urlsafe_b64encode(_rng_pool.take(nbytes)).rstrip(b"=").decode("ascii")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # CSP + sikkerhets-headers
 # Vi bruker nonce i index.html importmap-taggen og tillater esm.sh for moduler.
+# Alt unntatt nonce er konstant, så headerne bygges én gang ved oppstart.
+_CSP_PRE = "default-src 'self'; script-src 'self' 'nonce-"
+_CSP_POST = (
+    "' 'wasm-unsafe-eval' https://esm.sh; "
+    "style-src 'self'; "
+    "img-src 'self' data:; "
+    "connect-src 'self' ws: wss:; "
+    "font-src 'self'; "
+    "object-src 'none'; "
+    "base-uri 'self'; "
+    "form-action 'self'; "
+    "frame-ancestors 'none';"
+)
+_STATIC_HEADERS = {
+    "Referrer-Policy": "no-referrer",
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "Strict-Transport-Security": "max-age=31536000; includeSubDomains; preload",
+}
+
 @app.middleware("http")
 async def add_csp_header(request: Request, call_next):
-    nonce = secrets.token_urlsafe(16)
+    nonce = _token_urlsafe(16)
     request.state.csp_nonce = nonce
 
     response: Response = await call_next(request)
 
-    csp = (
-        "default-src 'self'; "
-        f"script-src 'self' 'nonce-{nonce}' 'wasm-unsafe-eval' https://esm.sh; "
-        "style-src 'self'; "
-        "img-src 'self' data:; "
-        "connect-src 'self' ws: wss:; "
-        "font-src 'self'; "
-        "object-src 'none'; "
-        "base-uri 'self'; "
-        "form-action 'self'; "
-        "frame-ancestors 'none';"
-    )
-
-    response.headers["Content-Security-Policy"] = csp
-    response.headers["Referrer-Policy"] = "no-referrer"
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains; preload"
+    response.headers["Content-Security-Policy"] = _CSP_PRE + nonce + _CSP_POST
+    response.headers.update(_STATIC_HEADERS)
     return response
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -133,9 +198,54 @@ ACCESS_FAIL_WINDOW = 600  # 10 min
 # Midlertidig ban ved misbruk (HTTP-siden; separat fra WS-ban)
 BAN_SECONDS = 300  # 5 min
 
-token_req_times: Dict[str, list] = defaultdict(list)   # ip -> [ts,...]
-access_fail_times: Dict[str, list] = defaultdict(list) # ip -> [ts,...]
-banned_ips_http: Dict[str, float] = {}                 # ip -> ban_until_ts
+# Forventet Origin (CSRF/WS), bygget én gang fra NT_PUBLIC_ORIGIN="https://a.no,https://b.no".
+# Uten env utledes forventet origin fra request-URL (som før).
+# Verdiene normaliseres slik nettleseren sender Origin: scheme://host[:port], små bokstaver,
+# uten default-port og uten sti.
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def _normalize_origin(raw: str) -> Optional[str]:
+    try:
+        parts = urlsplit(raw.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in _DEFAULT_PORTS or not parts.hostname:
+        return None
+    host = parts.hostname  # allerede lowercase, uten [] rundt IPv6
+    if ":" in host:
+        host = f"[{host}]"
+    origin = f"{scheme}://{host}"
+    if port and port != _DEFAULT_PORTS[scheme]:
+        origin = f"{origin}:{port}"
+    return origin
+
+def _load_public_origins(raw: str) -> frozenset:
+    origins = set()
+    for o in raw.split(","):
+        if not o.strip():
+            continue
+        norm = _normalize_origin(o)
+        if norm is None:
+            log.error("Ignoring invalid NT_PUBLIC_ORIGIN entry: %r", o.strip())
+            continue
+        origins.add(norm)
+    return frozenset(origins)
+
+_EXPECTED_ORIGINS = _load_public_origins(os.getenv("NT_PUBLIC_ORIGIN", ""))
+if _EXPECTED_ORIGINS:
+    log.info("Public origins loaded: %s", ", ".join(sorted(_EXPECTED_ORIGINS)))
+
+# IP-tabellene er LRU-ordnet og begrenset, ellers vokser de med hver ny IP (scannere, IP-churn).
+# Utgåtte oppføringer ryddes i tillegg periodisk (se _rate_table_gc_loop).
+RL_MAX_TRACKED_IPS = 100_000
+RL_GC_INTERVAL_SECONDS = 60
+RL_GC_CHUNK = 2000  # slettinger mellom hver yield til event-loopen
+
+token_req_times: OrderedDict[str, deque] = OrderedDict()   # ip -> deque[ts,...]
+access_fail_times: OrderedDict[str, deque] = OrderedDict() # ip -> deque[ts,...]
+banned_ips_http: OrderedDict[str, float] = OrderedDict()   # ip -> ban_until_ts
 
 def _client_ip_from_request(request: Request) -> str:
     xff = request.headers.get("x-forwarded-for", "")
@@ -143,6 +253,14 @@ def _client_ip_from_request(request: Request) -> str:
         return xff.split(",")[0].strip()
     return request.client.host or "0.0.0.0"
 
+def _origin_allowed(origin: str, url: URL, secure: bool) -> bool:
+    if not origin or origin in _EXPECTED_ORIGINS:
+        return True
+    if _EXPECTED_ORIGINS:
+        return False
+    expected = f"{'https' if secure else 'http'}://{url.hostname}"
+    return origin == expected or (bool(url.port) and origin == f"{expected}:{url.port}")
+
 def _ct_eq(a: str, b: str) -> bool:
     return hmac.compare_digest(a.encode("utf-8"), b.encode("utf-8"))
 
@@ -166,10 +284,21 @@ def _verify_access_code(raw: str) -> bool:
         ok = ok or _ct_eq(code, allowed)  # behold flat timing
     return ok
 
-def _prune_and_check(timestamps: list, limit: int, window: int) -> bool:
+def _lru_slot(table: OrderedDict, ip: str) -> deque:
+    """Hent/opprett IP-ens tidsstempler og merk IP-en som sist brukt; eldste IP kastes ved full tabell."""
+    ts = table.get(ip)
+    if ts is None:
+        ts = table[ip] = deque()
+        if len(table) > RL_MAX_TRACKED_IPS:
+            table.popitem(last=False)
+    else:
+        table.move_to_end(ip)
+    return ts
+
+def _prune_and_check(timestamps: deque, limit: int, window: int) -> bool:
     now = time.time()
     while timestamps and timestamps[0] < now - window:
-        timestamps.pop(0)
+        timestamps.popleft()  # O(1), i motsetning til list.pop(0)
     if len(timestamps) >= limit:
         return False
     timestamps.append(now)
@@ -185,56 +314,71 @@ def _is_http_banned(ip: str) -> bool:
     return False
 
 def _track_token_req(ip: str) -> bool:
-    return _prune_and_check(token_req_times[ip], TOKEN_REQ_LIMIT, TOKEN_REQ_WINDOW)
+    return _prune_and_check(_lru_slot(token_req_times, ip), TOKEN_REQ_LIMIT, TOKEN_REQ_WINDOW)
 
 def _track_access_failure(ip: str) -> bool:
-    ok = _prune_and_check(access_fail_times[ip], ACCESS_FAIL_LIMIT, ACCESS_FAIL_WINDOW)
+    ok = _prune_and_check(_lru_slot(access_fail_times, ip), ACCESS_FAIL_LIMIT, ACCESS_FAIL_WINDOW)
     return ok  # ok == fortsatt under grense
 
 def _ban_http(ip: str, seconds: int = BAN_SECONDS) -> None:
     banned_ips_http[ip] = time.time() + seconds
+    banned_ips_http.move_to_end(ip)  # hold ban-tabellen ordnet på utløp (se _sweep_front)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Rom-tokens (kortlevd, én-gangs) for å hindre gjette/ubudne joins
 TOKEN_TTL_SECONDS = 120  # 2 minutter
-# room_id -> { token:str -> (exp_ts:float, access_code_fingerprint:str) }
-_room_tokens: Dict[str, Dict[str, Tuple[float, str]]] = {}
+# NB: lagret i prosessminnet. Med flere workers (uvicorn --workers N, WEB_CONCURRENCY,
+# gunicorn) er et token utstedt av én worker ukjent for de andre, og det varsles ikke
+# om dette ved oppstart – kjør én worker (eller sticky routing) så lenge det ikke
+# finnes en delt backend (f.eks. Redis SET EX NX + GETDEL).
+#
+# Shardet på room_id over 16 dicts: hver dict holdes liten, så resize blir billigere.
+# (room_id, token) -> (exp_ts:float, access_code_fingerprint:str)
+ROOM_TOKEN_SHARDS = 16  # må være en potens av 2
+_room_token_shards: Tuple[Dict[Tuple[str, str], Tuple[float, str]], ...] = tuple(
+    {} for _ in range(ROOM_TOKEN_SHARDS)
+)
+# Min-heap (exp_ts, room_id, token) for lat utløp: kun toppen sjekkes pr. kall
+_token_exp_heap: List[Tuple[float, str, str]] = []
+
+# Rom-ID: 6–64 tegn fra [A-Za-z0-9_-]. Sjekkes med lengde + mengde-inklusjon (ren C) i stedet for regex.
+ROOM_ID_MIN_LEN = 6
+ROOM_ID_MAX_LEN = 64
+_ROOM_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
 
-ROOM_ID_RE = re.compile(r"^[A-Za-z0-9_-]{6,64}$")
+def _token_shard(room_id: str) -> Dict[Tuple[str, str], Tuple[float, str]]:
+    return _room_token_shards[hash(room_id) & (ROOM_TOKEN_SHARDS - 1)]
 
 def _validate_room_id(room_id: str) -> None:
-    if not ROOM_ID_RE.match(room_id):
+    if not (ROOM_ID_MIN_LEN <= len(room_id) <= ROOM_ID_MAX_LEN) or not _ROOM_ID_CHARS.issuperset(room_id):
         raise HTTPException(status_code=400, detail="Invalid room id")
 
+def _expire_room_tokens(now: float) -> None:
+    heap = _token_exp_heap
+    while heap and heap[0][0] <= now:
+        _exp, room_id, tok = heapq.heappop(heap)
+        _token_shard(room_id).pop((room_id, tok), None)  # kan allerede være brukt opp
+
 def _issue_room_token(room_id: str, access_fingerprint: str) -> Tuple[str, float]:
-    tok = secrets.token_urlsafe(32)
-    exp = time.time() + TOKEN_TTL_SECONDS
-    _room_tokens.setdefault(room_id, {})[tok] = (exp, access_fingerprint)
+    tok = _token_urlsafe(32)
+    now = time.time()
+    _expire_room_tokens(now)  # hold heapen liten også når ingen verifiserer
+    exp = now + TOKEN_TTL_SECONDS
+    _token_shard(room_id)[(room_id, tok)] = (exp, access_fingerprint)
+    heapq.heappush(_token_exp_heap, (exp, room_id, tok))
     return tok, exp
 
 def _verify_room_token(room_id: str, token: str, consume: bool = True) -> bool:
-    tokens = _room_tokens.get(room_id)
     now = time.time()
-    if not tokens:
-        return False
-    entry = tokens.get(token)
-    if not entry:
-        # rydde utløpte for hygiene (uten å signalisere noe)
-        for t, (e, _) in list(tokens.items()):
-            if e <= now:
-                tokens.pop(t, None)
-        return False
-    exp, _fp = entry
-    if exp <= now:
-        tokens.pop(token, None)
-        # rydde resten som er utløpt
-        for t, (e, _) in list(tokens.items()):
-            if e <= now:
-                tokens.pop(t, None)
+    _expire_room_tokens(now)
+    tokens = _token_shard(room_id)
+    key = (room_id, token)
+    entry = tokens.get(key)
+    if not entry or entry[0] <= now:
         return False
     if consume:
         # én-gangs
-        tokens.pop(token, None)
+        del tokens[key]
     return True
 
 class TokenReq(BaseModel):
@@ -262,11 +406,8 @@ async def api_room_token(req: TokenReq, request: Request):
 
     # Origin-sjekk (CSRF)
     origin = request.headers.get("origin", "")
-    base_scheme = "https" if request.url.scheme == "https" else "http"
-    expected1 = f"{base_scheme}://{request.url.hostname}"
-    expected2 = f"{expected1}:{request.url.port}" if request.url.port else expected1
-    if origin and origin not in (expected1, expected2):
-        log.warning("Suspicious token request origin=%s expected=%s|%s", origin, expected1, expected2)
+    if not _origin_allowed(origin, request.url, request.url.scheme == "https"):
+        log.warning("Suspicious token request origin=%s", origin)
         raise HTTPException(status_code=403, detail="Forbidden")
 
     if OPEN_ACCESS:
@@ -291,29 +432,103 @@ async def api_room_token(req: TokenReq, request: Request):
 
 # ─────────────────────────────────────────────────────────────────────────────
 # RoomManager
+# Hver peer har en begrenset kø + egen relay-task. broadcast legger bare rammen i
+# køene (put_nowait); en peer som ikke holder følge (full kø) kobles fra.
+PEER_QUEUE_SIZE = 32
+# Store rom: gi fra oss event-loopen etter hver N-te peer, så andre rom/tilkoblinger ikke sultes
+BROADCAST_BATCH = 50
+
+class _Peer:
+    __slots__ = ("ws", "queue", "task")
+
+    def __init__(self, ws: WebSocket, queue: asyncio.Queue):
+        self.ws = ws
+        self.queue = queue
+        self.task: Optional[asyncio.Task] = None
+
 class RoomManager:
     def __init__(self):
-        self.rooms: Dict[str, Set[WebSocket]] = {}
+        # Liste pr. rom: broadcast itererer uten kopi; join/leave er sjeldne og tåler O(N)
+        self.rooms: Dict[str, List[_Peer]] = {}
+        # Pågående close() for kastede peers (referanse holdes til tasken er ferdig)
+        self._closing: Set[asyncio.Task] = set()
 
     def add(self, room: str, ws: WebSocket):
-        self.rooms.setdefault(room, set()).add(ws)
+        peers = self.rooms.setdefault(room, [])
+        if any(p.ws is ws for p in peers):
+            return
+        peer = _Peer(ws, asyncio.Queue(PEER_QUEUE_SIZE))
+        peer.task = asyncio.create_task(self._relay(room, peer))
+        peers.append(peer)
 
     def remove(self, room: str, ws: WebSocket):
-        self.rooms.get(room, set()).discard(ws)
-
-    async def broadcast(self, room: str, sender: WebSocket, data: str):
-        peers = list(self.rooms.get(room, set()))
-        for peer in peers:
-            if peer.application_state != WebSocketState.CONNECTED:
-                self.remove(room, peer)
-                continue
-            if peer is sender:
+        peers = self.rooms.get(room)
+        if not peers:
+            return
+        for i, p in enumerate(peers):
+            if p.ws is ws:
+                del peers[i]
+                break
+        else:
+            return
+        if not peers:
+            self.rooms.pop(room, None)
+        if p.task is not asyncio.current_task():
+            p.task.cancel()
+
+    def _close_later(self, ws: WebSocket, code: int):
+        # close() venter på close-handshake; skal aldri blokkere avsenderens broadcast
+        task = asyncio.create_task(self._close_quietly(ws, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close_quietly(ws: WebSocket, code: int):
+        try:
+            await ws.close(code=code)
+        except Exception:
+            pass
+
+    async def _relay(self, room: str, peer: _Peer):
+        ws, queue = peer.ws, peer.queue
+        try:
+            while True:
+                data = await queue.get()
+                await ws.send_bytes(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug("Relay send failed, removing peer: %s", e)
+            self.remove(room, ws)
+
+    async def broadcast(self, room: str, sender: WebSocket, data: Union[bytes, str]):
+        # Kod én gang; samme bytes-objekt deles av alle peer-køene
+        payload = data if isinstance(data, (bytes, bytearray)) else data.encode("utf-8")
+        # Små rom: ingen await i løkka → lista kan ikke endres under iterasjon.
+        # Store rom yielder underveis og itererer derfor en kopi. Trege peers fjernes etterpå.
+        peers = self.rooms.get(room, ())
+        batched = len(peers) > BROADCAST_BATCH
+        if batched:
+            peers = tuple(peers)
+        # Ingen tilstandssjekk pr. peer: lukkede sockets oppdages av relay-tasken
+        # (send feiler → remove) og av endepunktets finally.
+        slow = None
+        for i, peer in enumerate(peers):
+            if batched and i and i % BROADCAST_BATCH == 0:
+                await asyncio.sleep(0)
+            if peer.ws is sender:
                 continue
             try:
-                await peer.send_text(data)
-            except Exception as e:
-                log.debug("Broadcast send failed, removing peer: %s", e)
-                self.remove(room, peer)
+                peer.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                slow = slow or []
+                slow.append(peer.ws)
+        if slow:
+            for ws in slow:
+                # Backpressure: peeren henger etter – kast den ut i stedet for å vente
+                log.debug("Peer queue full, dropping slow peer in room=%s", room)
+                self.remove(room, ws)
+                self._close_later(ws, 1013)  # try again later
 
 mgr = RoomManager()
 
@@ -328,6 +543,8 @@ async def index(request: Request):
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Rate limiting (per IP) – skiller mellom chat, control og bulk (chaff/ping)
+# Chat/control bruker token-bucket (LIMIT = burst, LIMIT/WINDOW = påfyll pr. sek),
+# implementert som GCRA: én float (teoretisk ankomsttid, TAT) pr. IP og klasse.
 # Soft-drop ved brudd. Chaff/ping verken broadcastes eller teller mot RL.
 
 CHAT_LIMIT = 90              # chat-meldinger ("t":"m")
@@ -346,11 +563,22 @@ WS_BAN_SECONDS = 60  # egen WS-ban
 
 MAX_MESSAGE_BYTES = 16384    # romsligere pga padding (3–5 KB hos oss)
 
-client_times_chat = defaultdict(list)   # ip -> [ts,...]
-client_times_ctrl = defaultdict(list)
-client_times_bulk = defaultdict(list)   # beholdt for ev. observasjon
-client_connect_times = defaultdict(list)
-banned_ips: Dict[str, float] = {}       # ip -> ban_until_ts (WS)
+# Faste svar-rammer, ferdig kodet (sendes binært som alle andre rammer)
+_RATE_TOO_BIG = b'{"t":"rate","reason":"too_big"}'
+_RATE_TOO_FAST = b'{"t":"rate","reason":"too_fast"}'
+
+# Sekunder pr. token og burst-toleranse ((LIMIT-1) tokens i forskudd).
+# _GCRA_SLACK tar høyde for float-avrunding slik at en full bøtte gir nøyaktig LIMIT.
+_GCRA_SLACK = 1e-3
+CHAT_INTERVAL = CHAT_WINDOW_SECONDS / CHAT_LIMIT
+CHAT_BURST = (CHAT_LIMIT - 1) * CHAT_INTERVAL + _GCRA_SLACK
+CTRL_INTERVAL = CTRL_WINDOW_SECONDS / CTRL_LIMIT
+CTRL_BURST = (CTRL_LIMIT - 1) * CTRL_INTERVAL + _GCRA_SLACK
+
+client_buckets_chat: OrderedDict[str, float] = OrderedDict()  # ip -> TAT
+client_buckets_ctrl: OrderedDict[str, float] = OrderedDict()
+client_connect_times: OrderedDict[str, deque] = OrderedDict()   # ip -> deque[ts,...]
+banned_ips: OrderedDict[str, float] = OrderedDict()  # ip -> ban_until_ts (WS)
 
 def _client_ip_from_ws(ws: WebSocket) -> str:
     xff = ws.headers.get("x-forwarded-for")
@@ -358,10 +586,10 @@ def _client_ip_from_ws(ws: WebSocket) -> str:
         return xff.split(",")[0].strip()
     return ws.client.host or "0.0.0.0"
 
-def _prune_and_check_ws(timestamps: list, limit: int, window: int) -> bool:
+def _prune_and_check_ws(timestamps: deque, limit: int, window: int) -> bool:
     now = time.time()
     while timestamps and timestamps[0] < now - window:
-        timestamps.pop(0)
+        timestamps.popleft()
     if len(timestamps) >= limit:
         return False
     timestamps.append(now)
@@ -378,20 +606,28 @@ def is_banned(client_ip: str) -> bool:
     return False
 
 def is_connect_limited(client_ip: str) -> bool:
-    ts = client_connect_times[client_ip]
+    ts = _lru_slot(client_connect_times, client_ip)
     ok = _prune_and_check_ws(ts, CONNECT_LIMIT, CONNECT_WINDOW_SECONDS)
     if not ok:
         banned_ips[client_ip] = time.time() + WS_BAN_SECONDS
+        banned_ips.move_to_end(client_ip)
         log.debug("[SECURITY] Connect limit exceeded. WS-banned %s for %s seconds.", client_ip, WS_BAN_SECONDS)
     return not ok
 
-def _classify_message_kind(msg_text: str) -> str:
+# Kontrakt med klienten: "t" er første nøkkel i hver ramme. Da avgjøres typen av
+# de første bytene uten full JSON-parsing; alt annet faller tilbake til parseren.
+CLASSIFIER_RE = re.compile(rb'\s*\{\s*"t"\s*:\s*"([^"\\]{1,10})"')
+CLASSIFIER_SCAN_BYTES = 64
+_KIND_BY_TYPE = {b"m": "chat", b"chaff": "bulk", b"ping": "bulk"}
+
+def _classify_parsed(msg: bytes) -> str:
     """
+    Fallback når CLASSIFIER_RE bommer (hurtigstien ligger inline i websocket_endpoint).
     Returner 'bulk' for chaff/ping, 'chat' for t='m', ellers 'ctrl'.
     Faller tilbake til 'chat' hvis JSON ikke kan parses (safe default).
     """
     try:
-        obj = json.loads(msg_text)
+        obj = _json_loads(msg)
         t = obj.get("t")
         if t in ("chaff", "ping"):
             return "bulk"
@@ -401,22 +637,74 @@ def _classify_message_kind(msg_text: str) -> str:
     except Exception:
         return "chat"
 
-def is_rate_limited_message(client_ip: str, msg_text: str) -> bool:
-    kind = _classify_message_kind(msg_text)
+def _take_token(buckets: OrderedDict, client_ip: str, interval: float, burst: float) -> bool:
+    now = time.time()
+    tat = buckets.get(client_ip)
+    if tat is None:
+        # Ny IP starter med full bøtte
+        buckets[client_ip] = now + interval
+        if len(buckets) > RL_MAX_TRACKED_IPS:
+            buckets.popitem(last=False)
+        return True
+    buckets.move_to_end(client_ip)
+    if tat < now:
+        tat = now
+    elif tat - now > burst:
+        return False
+    buckets[client_ip] = tat + interval
+    return True
+
+def is_rate_limited_message(client_ip: str, kind: str) -> bool:
     if kind == "bulk":
         # Chaff/ping teller ikke mot rate limit
         return False
     if kind == "ctrl":
-        return not _prune_and_check_ws(client_times_ctrl[client_ip], CTRL_LIMIT, CTRL_WINDOW_SECONDS)
+        return not _take_token(client_buckets_ctrl, client_ip, CTRL_INTERVAL, CTRL_BURST)
     # chat (t='m')
-    return not _prune_and_check_ws(client_times_chat[client_ip], CHAT_LIMIT, CHAT_WINDOW_SECONDS)
+    return not _take_token(client_buckets_chat, client_ip, CHAT_INTERVAL, CHAT_BURST)
 
-def _is_bulk(msg_text: str) -> bool:
-    try:
-        t = json.loads(msg_text).get("t")
-        return t in ("chaff", "ping")
-    except Exception:
-        return False
+# ─────────────────────────────────────────────────────────────────────────────
+# Periodisk opprydding av IP-tabellene
+
+# Tabellene er ordnet eldst først (LRU / ban-tidspunkt), så sweepen går fra fronten og
+# stopper ved første levende oppføring: kostnaden følger antall utgåtte, ikke tabellstørrelsen.
+# Stale oppføringer bak en levende tas ved neste runde (eller av LRU-taket).
+
+async def _sweep_front(table: OrderedDict, is_stale) -> int:
+    removed = 0
+    while table:
+        ip = next(iter(table))
+        if not is_stale(table[ip]):
+            break
+        del table[ip]
+        removed += 1
+        if removed % RL_GC_CHUNK == 0:
+            await asyncio.sleep(0)  # ikke stopp andre tilkoblinger ved store ryddinger
+    return removed
+
+async def _sweep_rate_tables(now: float) -> int:
+    """Fjern IP-er uten aktive tidsstempler / med full bøtte / utløpt ban. Returnerer antall fjernet."""
+    removed = 0
+    for table, window in (
+        (token_req_times, TOKEN_REQ_WINDOW),
+        (access_fail_times, ACCESS_FAIL_WINDOW),
+        (client_connect_times, CONNECT_WINDOW_SECONDS),
+    ):
+        cutoff = now - window
+        removed += await _sweep_front(table, lambda ts: not ts or ts[-1] < cutoff)
+    for table in (client_buckets_chat, client_buckets_ctrl):
+        # TAT i fortiden = full bøtte, det samme som en ny IP – trenger ikke huskes
+        removed += await _sweep_front(table, lambda tat: tat <= now)
+    for table in (banned_ips_http, banned_ips):
+        removed += await _sweep_front(table, lambda until: until <= now)
+    return removed
+
+async def _rate_table_gc_loop():
+    while True:
+        await asyncio.sleep(RL_GC_INTERVAL_SECONDS)
+        removed = await _sweep_rate_tables(time.time())
+        if removed:
+            log.debug("[RL] GC removed %d stale IP entries", removed)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # WebSocket endepunkt
@@ -449,11 +737,8 @@ async def websocket_endpoint(ws: WebSocket, room_id: str):
 
     # Origin-sjekk (nettlesere sender Origin)
     origin = ws.headers.get("origin", "")
-    base_scheme = "https" if ws.url.scheme == "wss" else "http"
-    expected1 = f"{base_scheme}://{ws.url.hostname}"
-    expected2 = f"{expected1}:{ws.url.port}" if ws.url.port else expected1
-    if origin and origin not in (expected1, expected2):
-        log.warning("[SECURITY] WS origin mismatch: %s (expected %s|%s)", origin, expected1, expected2)
+    if not _origin_allowed(origin, ws.url, ws.url.scheme == "wss"):
+        log.warning("[SECURITY] WS origin mismatch: %s", origin)
         await ws.close(code=4003)
         return
 
@@ -468,34 +753,63 @@ async def websocket_endpoint(ws: WebSocket, room_id: str):
     await ws.accept(subprotocol=token)
     mgr.add(room_id, ws)
 
+    # Hot loop: slå opp globaler/metoder én gang (LOAD_FAST i stedet for LOAD_GLOBAL/attr-oppslag)
+    _receive = ws.receive
+    _match = CLASSIFIER_RE.match
+    _kinds = _KIND_BY_TYPE
+    _parse_kind = _classify_parsed
+    _rate_limited = is_rate_limited_message
+    _bcast = mgr.broadcast
+    _debug = log.debug
+    max_bytes = MAX_MESSAGE_BYTES
+    scan = CLASSIFIER_SCAN_BYTES
+
     try:
         while True:
-            msg = await ws.receive_text()
+            message = await _receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # Binære rammer videresendes urørt; tekst-rammer (eldre klienter) kodes én gang
+            msg = message.get("bytes")
+            if msg is None:
+                msg = message["text"].encode("utf-8")
 
             # Størrelse: soft drop (ingen broadcast) og hint tilbake
-            if len(msg.encode("utf-8")) > MAX_MESSAGE_BYTES:
+            if len(msg) > max_bytes:
                 try:
-                    await ws.send_text('{"t":"rate","reason":"too_big"}')
+                    await ws.send_bytes(_RATE_TOO_BIG)
                 except Exception:
                     pass
                 continue
 
+            # Klassifiser én gang (hurtigsti på prefiks, ellers full parsing)
+            m = _match(msg, 0, scan)
+            kind = _kinds.get(m.group(1), "ctrl") if m else _parse_kind(msg)
+
+            # Chaff/ping: sink på server – teller ikke mot RL og broadcastes ikke
+            if kind == "bulk":
+                continue
+
             # Rate-limit: soft drop + hint
-            if is_rate_limited_message(client_ip, msg):
-                log.debug("[RL] Soft-drop from %s", client_ip)
+            if _rate_limited(client_ip, kind):
+                _debug("[RL] Soft-drop from %s", client_ip)
                 try:
-                    await ws.send_text('{"t":"rate","reason":"too_fast"}')
+                    await ws.send_bytes(_RATE_TOO_FAST)
                 except Exception:
                     pass
                 continue
 
-            # Chaff/ping: sink på server – ikke broadcast til andre
-            if _is_bulk(msg):
-                continue
-
-            await mgr.broadcast(room_id, ws, msg)
+            await _bcast(room_id, ws, msg)
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Alltid ut av rommet (stopper også relay-tasken)
         mgr.remove(room_id, ws)
 
 # .venv\Scripts\Activate.ps1
 # uvicorn backend.main:app --reload --port 5000
+#
+# Produksjon (Linux/macOS): uvloop + httptools, og uten permessage-deflate –
+# rammene er kryptert/padding og komprimeres dårlig, så deflate koster bare CPU.
+# uvicorn backend.main:app --port 5000 --loop uvloop --http httptools --ws websockets --ws-per-message-deflate false
+# Én worker: rom-tokens og rate-limits ligger i prosessminnet (ikke bruk --workers N).
@@ -113,6 +113,8 @@ const pendingGK=new Map(), gkRetryTimers=new Map();
 
 let CID=genUUID();
 let localKeys, grp, ws=null;
+// WS-rammer går binært (UTF-8 JSON) – serveren videresender bytes uten å dekode
+const wsEnc=new TextEncoder(), wsDec=new TextDecoder();
 let role=null;
 let capsuleInfo=null;
 let nextCid = null; // ← NEW: pre-generert ID som vises i confirm og brukes ved join
@@ -147,6 +149,7 @@ function randomColor(){
   usedHues.add(hue);
   return `hsl(${hue},70%,50%)`;
 }
+// NB: "t" må være første nøkkel i obj – serveren klassifiserer rammer på prefikset
 function sendMessage(obj){
   if(!ws) return;
   const msg={...obj};
@@ -154,7 +157,7 @@ function sendMessage(obj){
   const target=MIN_PACKET_SIZE+Math.floor(Math.random()*(MAX_PACKET_SIZE-MIN_PACKET_SIZE+1));
   const pad=target-overhead;
   if(pad>0) msg.pad=randomString(pad);
-  ws.send(JSON.stringify(msg));
+  ws.send(wsEnc.encode(JSON.stringify(msg)));
 }
 async function getRoomToken(roomId){
   // Krev kode før vi forsøker
@@ -487,6 +490,7 @@ async function startChat(){
 
   const proto=(location.protocol==="https:")?"wss":"ws";
   ws=new WebSocket(`${proto}://${location.host}/ws/${roomId}`, token);
+  ws.binaryType="arraybuffer";
 
   ws.onopen=()=>{
     peers.set(CID,{ xPub:localKeys.xPub, pqPub:localKeys.pqPub, idPub:localKeys.idPub, color:randomColor() });
@@ -498,7 +502,7 @@ async function startChat(){
   };
 
   ws.onmessage=async ({data})=>{
-    let m; try{ m=JSON.parse(data);}catch{return;}
+    let m; try{ m=JSON.parse(typeof data==="string"?data:wsDec.decode(data));}catch{return;}
 
     if(m.t==="leave"){
       peers.delete(m.cid);